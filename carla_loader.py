@@ -1,14 +1,114 @@
 import glob
+import os
 
 import numpy as np
 import h5py
 import torch
+import torch.distributed as dist
 from torchvision import transforms
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
+from torch.utils.data.distributed import DistributedSampler
 
 
 
 
+class CarlaH5Dataset(Dataset):
+    def __init__(self, data_dir, sequence_len=200):
+        self.data_list = sorted(glob.glob(os.path.join(data_dir, '*.h5')))
+        if not self.data_list:
+            raise FileNotFoundError("no .h5 files found in '{}'".format(data_dir))
+        self.sequence_len = sequence_len
+        self.transform = transforms.ToTensor()
+
+    def __len__(self):
+        return self.sequence_len * len(self.data_list)
+
+    def __getitem__(self, idx):
+        data_idx = idx // self.sequence_len
+        file_idx = idx % self.sequence_len
+        with h5py.File(self.data_list[data_idx], 'r') as h5_file:
+            img = self.transform(h5_file['rgb'][file_idx])
+            target = np.array(h5_file['targets'][file_idx], dtype=np.float32)
+
+        # 2 Follow lane, 3 Left, 4 Right, 5 Straight
+        # -> 0 Follow lane, 1 Left, 2 Right, 3 Straight
+        command = int(target[24]) - 2
+        # Steer, Gas, Brake
+        target_vec = np.zeros((4, 3), dtype=np.float32)
+        target_vec[command, :] = target[:3]
+        # in km/h, <90
+        speed = np.array([target[10] / 90, ], dtype=np.float32)
+        mask_vec = np.zeros((4, 3), dtype=np.float32)
+        mask_vec[command, :] = 1
+
+        return img, speed, target_vec.reshape(-1), mask_vec.reshape(-1)
+
+
 class CarlaH5Data():
-    def __init__(self):
-        pass
+    def __init__(self, train_folder, eval_folder, batch_size=4, num_workers=4,
+                 distributed=False):
+        # pinned batches are what make the non_blocking copies in main.py
+        # asynchronous, persistent workers are not respawned every epoch
+        loader_kwargs = dict(
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=2 if num_workers > 0 else None,
+        )
+        train_dataset = CarlaH5Dataset(train_folder)
+        # each process trains on its own shard, shuffled by the sampler
+        train_sampler = DistributedSampler(train_dataset) if distributed else None
+        # eval is sharded too and the meters are summed over the processes
+        # afterwards, strided shards cover every sample exactly once where
+        # a DistributedSampler would pad them with repeated samples
+        eval_dataset = CarlaH5Dataset(eval_folder)
+        if distributed:
+            eval_dataset = Subset(eval_dataset, range(
+                dist.get_rank(), len(eval_dataset), dist.get_world_size()))
+        self.loaders = {
+            "train": torch.utils.data.DataLoader(
+                train_dataset,
+                shuffle=train_sampler is None,
+                sampler=train_sampler,
+                # a constant batch shape for the compiled model
+                drop_last=True,
+                **loader_kwargs),
+            "eval": torch.utils.data.DataLoader(
+                eval_dataset,
+                shuffle=False,
+                # every sample is evaluated, the partial tail batch costs one
+                # extra static compile of the model
+                **loader_kwargs),
+        }
+
+
+class CUDAPrefetcher():
+    '''
+        Copy the next batch to the gpu on a side stream while the
+        current one is being computed
+    '''
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.copy_stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.copy_stream):
+            self.next_batch = [t.cuda(non_blocking=True) for t in batch]
+
+    def next(self):
+        stream = torch.cuda.current_stream()
+        stream.wait_stream(self.copy_stream)
+        batch = self.next_batch
+        if batch is not None:
+            # allocated on the copy stream, so tell the allocator where they are used
+            for t in batch:
+                t.record_stream(stream)
+            self.preload()
+        return batch
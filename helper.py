@@ -1,8 +1,17 @@
+import io
 import os
+import queue
 import random
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+import torch.distributed as dist
+
+
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_pending_save = None
 
 
 class AverageMeter(object):
@@ -24,10 +33,107 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-    def save_checkpoint(state, id_, is_best, filename='checkpoint.pth'):
-        torch.save(state, filename)
-        if is_best:
-            shutil.copyfile(
-                filename,
-                os.path.join("save_models", "{}_best.pth".format(id_))
-                )
\ No newline at end of file
+
+class MeterGroup(object):
+    '''
+        A set of named average meters kept as one tensor on the gpu,
+        every step updates all of them with a single vector op
+    '''
+    def __init__(self, names, device=None):
+        self.names = list(names)
+        self.reset(device)
+
+    def reset(self, device=None):
+        self.val = torch.zeros(len(self.names), device=device)
+        self.sum = torch.zeros(len(self.names), device=device)
+        self.count = 0
+
+    def update(self, values, n=1):
+        self.val = values.detach()
+        self.sum += self.val * n
+        self.count += n
+
+    def _check_count(self):
+        if self.count == 0:
+            raise RuntimeError("no samples were accumulated for {}".format(", ".join(self.names)))
+
+    def cpu(self):
+        '''
+            Copy (val, avg) of every meter back to the host in one transfer
+        '''
+        self._check_count()
+        val, avg = torch.stack([self.val, self.sum / self.count]).tolist()
+        return {name: (v, a) for name, v, a in zip(self.names, val, avg)}
+
+    def all_reduce(self):
+        '''
+            Sum the meters over all distributed processes
+        '''
+        count = torch.tensor(float(self.count), device=self.sum.device)
+        dist.all_reduce(self.sum)
+        dist.all_reduce(count)
+        self.count = count.item()
+
+    def avg_cpu(self):
+        self._check_count()
+        avg = (self.sum / self.count).tolist()
+        return dict(zip(self.names, avg))
+
+
+class LogWorker(threading.Thread):
+    '''
+        Own the SummaryWriter on a daemon thread and write the queued
+        (tag, value, step) tuples with add_scalar
+    '''
+    def __init__(self, writer):
+        super(LogWorker, self).__init__(daemon=True)
+        self.writer = writer
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, value, step = item
+            self.writer.add_scalar(tag, value, step)
+
+    def close(self):
+        # drain what is queued before the writer is torn down
+        self.queue.put(None)
+        self.join()
+        self.writer.close()
+
+
+def _write_checkpoint(data, id_, is_best, filename):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    if is_best:
+        shutil.copyfile(
+            filename,
+            os.path.join("save_models", "{}_best.pth".format(id_))
+            )
+
+
+def save_checkpoint(state, id_, is_best, filename='checkpoint.pth'):
+    '''
+        Serialize the state in memory and write it to disk on a
+        background thread, so training continues during the file I/O
+    '''
+    global _pending_save
+    buf = io.BytesIO()
+    torch.save(state, buf)
+    # one checkpoint in flight at a time, this also re-raises a failed write
+    wait_checkpoint()
+    _pending_save = _save_executor.submit(
+        _write_checkpoint, buf.getvalue(), id_, is_best, filename)
+
+
+def wait_checkpoint():
+    '''
+        Block until the last submitted checkpoint is on disk
+    '''
+    global _pending_save
+    if _pending_save is not None:
+        _pending_save.result()
+        _pending_save = None
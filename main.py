@@ -12,12 +12,13 @@ import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
 # from tensorboardX import SummaryWriter
 from torch.utils.tensorboard import SummaryWriter
 
 from carla_net import CarlaNet, FinalNet
-from carla_loader import CarlaH5Data
-from helper import AverageMeter, save_checkpoint
+from carla_loader import CarlaH5Data, CUDAPrefetcher
+from helper import AverageMeter, LogWorker, MeterGroup, save_checkpoint, wait_checkpoint
 
 
 parser = argparse.ArgumentParser(description='Carla CIL')
@@ -38,13 +39,16 @@ parser.add_argument('--print_frequency', default=10, type=int, metavar='N')
 parser.add_argument('--resume', default='', type=str, metavar='PATH', help='path to latest checkpoint(default: NONE')
 parser.add_argument('--evaluate', '-e', dest='evaluate', action='store_true', help='evaluate model on validation set')
 parser.add_argument('--evaluation_log', default='', type=str, metavar='PATH', help='path to log evaluation results')
-parser.add_argument('--world_size', default=1, type=int, help='number of distributed process')
 parser.add_argument('--seed', default=None, type=int, help='seed for initializing training')
 parser.add_argument('--gpu', default=None, type=int, help='GPU id to use')
 parser.add_argument('--net_structure', default=2, type=int, help='Network structure 1/2/3/4')
+parser.add_argument('--trace_graph', action='store_true', help='add the model graph to tensorboard')
 
 
 def output_log(output_str, logger=None):
+    # the console, like the log file and tensorboard, belongs to the first process
+    if args.rank != 0:
+        return
     print ("[{}]:{}".format(datetime.datetime.now(), output_str))
     if logger is not None:
         logger.critical("[{}]:{}".format(datetime.datetime.now(), output_str))
@@ -54,19 +58,92 @@ def log_args(logger):
     pass
 
 
+@torch.compile(mode="reduce-overhead", fullgraph=True)
+def _uncert_loss(branches_out, target, pred_speed, speed,
+                 log_var_control, log_var_speed, mask, bw, sw):
+    # the whole elementwise chain is fused by inductor instead of
+    # launching one kernel per op, every output stays a gpu scalar
+    branch_diff = branches_out-target
+    branch_square = branch_diff*branch_diff
+    inv_var_control = torch.exp(-log_var_control)
+    branch_loss = torch.mean((inv_var_control*branch_square+log_var_control)*0.5*mask)*4
+
+    speed_diff = pred_speed-speed
+    speed_square = speed_diff*speed_diff
+    inv_var_speed = torch.exp(-log_var_speed)
+    speed_loss = torch.mean((inv_var_speed*speed_square+log_var_speed)*0.5)
+
+    uncertain_loss = bw*branch_loss+sw*speed_loss
+
+    with torch.no_grad():           # the wrapped section's gradient won't be tracked when in operation
+        ori_loss = bw * torch.mean(branch_square*mask*4)\
+            + sw * torch.mean(speed_square)
+        # exp(log_var) as the reciprocal of the exp already taken above
+        uncertain_control_mean = torch.mean(torch.reciprocal(inv_var_control) * mask * 4)
+        uncertain_speed_mean = torch.mean(torch.reciprocal(inv_var_speed))
+
+    return uncertain_loss, branch_loss, speed_loss, ori_loss, \
+        uncertain_control_mean, uncertain_speed_mean
+
+
 def main():
     global args
     args = parser.parse_args()
+    # before any forward pass, so the algorithm search runs on the real input shape
+    cudnn.benchmark = True
+
+    # the setting of parallelism, one process per gpu launched with torchrun
+    args.distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    args.rank = 0
+    if args.distributed:
+        args.gpu = int(os.environ["LOCAL_RANK"])
+    # pin the device once, every later .cuda() goes to it, this has to
+    # happen before nccl is initialized so each rank binds its own gpu
+    if args.gpu is not None:
+        torch.cuda.set_device(args.gpu)
+    if args.distributed:
+        dist.init_process_group("nccl")
+        args.rank = dist.get_rank()
+
     log_dir = os.path.join("./", "logs", args.id)
     run_dir = os.path.join("./", "runs", args.id)
     save_weight_dir = os.path.join("./save_models", args.id)
-    os.makedirs(log_dir)
-    os.makedirs(save_weight_dir)
-
-    logging.basicConfig(filename=os.path.join(log_dir, "carla_training.log"), level=logging.ERROR)
-    tsbd = SummaryWriter(log_dir=run_dir)
+    # logs, tensorboard and checkpoints are only written by the first process
+    if args.rank == 0:
+        os.makedirs(log_dir)
+        os.makedirs(save_weight_dir)
+        logging.basicConfig(filename=os.path.join(log_dir, "carla_training.log"), level=logging.ERROR)
+        tsbd = SummaryWriter(log_dir=run_dir)
+        # tensorboard file writes happen on their own thread
+        log_worker = LogWorker(tsbd)
+        log_worker.start()
+        log_queue = log_worker.queue
+    else:
+        logging.disable(logging.CRITICAL)
+        tsbd = None
+        log_worker = None
+        log_queue = None
     log_args(logging)
 
+    # every way out of the run, early returns and exceptions included,
+    # drains the pending checkpoint and the queued scalars
+    try:
+        main_worker(save_weight_dir, tsbd, log_queue)
+    finally:
+        # nested, so a failed checkpoint write still closes the log worker
+        # and the process group before its error propagates
+        try:
+            wait_checkpoint()
+        finally:
+            try:
+                if log_worker is not None:
+                    log_worker.close()
+            finally:
+                if args.distributed:
+                    dist.destroy_process_group()
+
+
+def main_worker(save_weight_dir, tsbd, log_queue):
     # the setting of seed
     if args.seed is not None:
         random.seed(args.seed)
@@ -79,31 +156,46 @@ def main():
                    'from checkpoints', logger=logging)
 
     # the setting of gpu
-    if args.gpu is not None:
+    if args.gpu is not None and not args.distributed:
         output_log('You have chosen a specific GPU which will completely disable data parallelism', logger=logging)
 
-    # the setting of parallelism
-    args.distributed = args.world_size > 1  # judgement
-    if args.distributed:
-        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url, world_size=args.world_size, rank=0)
-
     model = FinalNet(args.net_structure)
     criterion = nn.MSELoss()
 
     # load the carla_net parameters
-    model.carla_net.load_state_dict(torch.load("./save_models/new_structure_best.pth")['state_dict'])
-
-    # tensorboard usage
-    tsbd.add_graph(model, (torch.zeros(1, 3, 88, 200), torch.zeros(1, 1)))
-
-    if args.gpu is not None:
-        model = model.cuda(args.gpu)
-    else:
-        model = torch.nn.DataParallel(model).cuda()
-
-    optimizer = optim.Adam(model.uncertain_net.parameters(), args.lr, betas=(0.7, 0.85))
+    # memory mapped and restricted to tensors/containers, copied into the params by load_state_dict
+    model.carla_net.load_state_dict(torch.load(
+        "./save_models/new_structure_best.pth",
+        map_location='cpu', weights_only=True, mmap=True)['state_dict'])
+    # only the uncertain_net is optimized, so no gradients are kept for the carla_net
+    model.carla_net.requires_grad_(False)
+
+    model = model.cuda()
+    # NHWC lets cudnn pick the tensor core conv kernels
+    model = model.to(memory_format=torch.channels_last)
+
+    # tensorboard usage, tracing is slow so it is opt-in
+    if args.trace_graph and tsbd is not None:
+        tsbd.add_graph(model, (
+            torch.zeros(1, 3, 88, 200).cuda().to(memory_format=torch.channels_last),
+            torch.zeros(1, 1).cuda()))
+    model_without_ddp = model
+    # uploaded once, a python float would be copied to the gpu on every step
+    args.loss_weights = (torch.tensor(args.branch_weight).cuda(),
+                         torch.tensor(args.speed_weight).cuda())
+    if args.distributed:
+        model = DDP(model, device_ids=[args.gpu],
+                    gradient_as_bucket_view=True, static_graph=True)
+    # fixed input shapes, so inductor can autotune its kernels for them
+    model = torch.compile(model, mode="max-autotune", fullgraph=False, dynamic=False)
+
+    # fused, so the GradScaler unscales and skips inf steps on the gpu without a sync
+    optimizer = optim.Adam(model_without_ddp.uncertain_net.parameters(), args.learning_rate, betas=(0.7, 0.85),
+                           fused=True)
     # the adjustment of the lr
     lr_scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_step, gamma=args.lr_gamma)
+    # loss scaling for the fp16 forward/backward
+    scaler = torch.amp.GradScaler("cuda")
     best_prec = math.inf
 
     # optionally resume from a checkpoint
@@ -111,19 +203,24 @@ def main():
         args.resume = os.path.join(save_weight_dir, args.resume)
         if os.path.isfile(args.resume):
             output_log("=> loading checkpoint'{}'".format(args.resume), logging)
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location='cpu', weights_only=True, mmap=True)
             args.start_epoch = checkpoint['epoch']
-            model.load_state_dict(checkpoint['state_dict'])
+            model_without_ddp.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             lr_scheduler.load_state_dict(checkpoint['scheduler'])
+            if 'scaler' in checkpoint:
+                scaler.load_state_dict(checkpoint['scaler'])
             best_prec = checkpoint['best_prec']
             output_log("=> loaded checkpoint'{}'".format(args.resume), logging)
         else:
             output_log("=> no checkpoint found at '{}'".format(args.resume), logging)
 
-    cudnn.benchmark = True   # where to add this line of code
-
-    carla_data = CarlaH5Data()      #  unfinished
+    carla_data = CarlaH5Data(
+        train_folder=args.train_dir,
+        eval_folder=args.eval_dir,
+        batch_size=args.batch_size,
+        num_workers=args.worker,
+        distributed=args.distributed)
 
     train_loader = carla_data.loaders["train"]
     eval_loader = carla_data.loaders["eval"]
@@ -137,197 +234,206 @@ def main():
         if args.evaluate_log =="":
             output_log("=> please set evaluate log path with --evaluate-log<log-path>")
 
-        evaluate(eval_loader, model, criterion, 0, tsbd)
+        evaluate(eval_loader, model, criterion, 0, log_queue)
         return
 
     for epoch in range(args.start_epoch, args.epochs):   # (0,90)
-        lr_scheduler.step()         # lr_scheduler needs to step when using
-        branch_losses, speed_losses, losses = train(train_loader, model, criterion, optimizer, epoch, tsbd)
+        if args.distributed:
+            train_loader.sampler.set_epoch(epoch)
+        branch_losses, speed_losses, losses = train(train_loader, model, criterion, optimizer, scaler, epoch, log_queue)
+        # once per epoch after its optimizer steps, before the state is saved
+        # so a resumed run continues with the lr of the next epoch
+        lr_scheduler.step()
 
-        prec = evaluate(eval_loader, model, criterion, epoch, tsbd)
+        prec = evaluate(eval_loader, model, criterion, epoch, log_queue)
 
         # rememeber best prec@1 and save checkpoint
         is_best = prec < best_prec
         best_prec = min(prec, best_prec)
-        save_checkpoint(
-            {'epoch': epoch+1,
-             'state_dict': model.state_dict(),
-             'best_prec': best_prec,
-             'scheduler': lr_scheduler.state_dict(),
-             'optimizer': optimizer.state_dict()},
-            args.id,
-            is_best,
-            os.path.join(save_weight_dir, "{}_{}.pth".format(epoch+1, args.id))
-        )
-
-
-def train(loader, model, criterion, optimizer, epoch, writer):
+        if args.rank == 0:
+            save_checkpoint(
+                {'epoch': epoch+1,
+                 'state_dict': model_without_ddp.state_dict(),
+                 'best_prec': best_prec,
+                 'scheduler': lr_scheduler.state_dict(),
+                 'optimizer': optimizer.state_dict(),
+                 'scaler': scaler.state_dict()},
+                args.id,
+                is_best,
+                os.path.join(save_weight_dir, "{}_{}.pth".format(epoch+1, args.id))
+            )
+
+
+def train(loader, model, criterion, optimizer, scaler, epoch, log_queue):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    uncertain_losses = AverageMeter()
-    ori_losses = AverageMeter()
-    branch_losses = AverageMeter()
-    speed_losses = AverageMeter()
-    uncertain_control_means = AverageMeter()
-    uncertain_speed_means = AverageMeter()
+    meters = MeterGroup(['branch_loss', 'speed_loss', 'uncertain_loss', 'ori_loss',
+                         'control_uncertain', 'speed_uncertain'], device='cuda')
 
     # train to train mode
     model.train()
     end = time.time()
     step = epoch*len(loader)
-    for i, (img, speed, target, mask) in enumerate(loader):
+    # the host to device copies of the next batch overlap this step's compute
+    prefetcher = CUDAPrefetcher(loader)
+    batch = prefetcher.next()
+    i = 0
+    while batch is not None:
+        img, speed, target, mask = batch
         data_time.update(time.time()-end)
 
-        # if args.gpu is not None
-        img = img.cuda(args.gpu, non_blocking=True)
-        speed = speed.cuda(args.gpu, non_blocking=True)
-        target = target.cuda(args.gpu, non_blocking=True)
-        mask = mask.cuda(args.gpu, non_blocking=True)
-
-        if args.net_structure != 1:
-            branches_out, pred_speed, log_var_control, log_var_speed = model(img, speed)
+        # recorded on the stream, the gpu time is only read back when printing
+        batch_start = torch.cuda.Event(enable_timing=True)
+        batch_end = torch.cuda.Event(enable_timing=True)
+        batch_start.record()
 
-            branch_square = torch.pow((branches_out-target), 2)
-            branch_loss = torch.mean((torch.exp(-log_var_control)*branch_square+log_var_speed)*0.5*mask)*4
+        img = img.to(memory_format=torch.channels_last, non_blocking=True)
 
-            speed_square = torch.pow((pred_speed-speed), 2)
-            speed_loss = torch.mean((torch.exp(-log_var_speed)*speed_square+log_var_speed)*0.5)
-
-            uncertain_loss = args.branch_weight*branch_loss+args.speed_weight*speed_loss
-
-            with torch.no_grad():           # the wrapped section's gradient won't be tracked when in operation
-                ori_loss = args.branch_weight * torch.mean(branch_square*mask*4)\
-                    + args.speed_weight * torch.mean(speed_square)
-                uncertain_control_mean = torch.mean(torch.exp(log_var_control) * mask * 4)
-                uncertain_speed_mean = torch.mean(torch.exp(log_var_speed))
-
-                ori_losses.update(ori_loss.item(), args.batch_size)
-                uncertain_control_means.update(uncertain_control_mean.item(), args.bacth_size)
-                uncertain_speed_means.update(uncertain_speed_mean.item(), args.bacth_size)
+        # outputs of the compiled model and loss live in cuda graph memory
+        torch.compiler.cudagraph_mark_step_begin()
+        if args.net_structure != 1:
+            with torch.autocast("cuda", dtype=torch.float16):
+                branches_out, pred_speed, log_var_control, log_var_speed = model(img, speed)
+            # the losses, and exp(-log_var) in particular, stay in fp32
+            branches_out, pred_speed = branches_out.float(), pred_speed.float()
+            log_var_control, log_var_speed = log_var_control.float(), log_var_speed.float()
+
+            uncertain_loss, branch_loss, speed_loss, ori_loss, \
+                uncertain_control_mean, uncertain_speed_mean = _uncert_loss(
+                    branches_out, target, pred_speed, speed,
+                    log_var_control, log_var_speed, mask,
+                    *args.loss_weights)
 
         else:
-            branches_out, pred_speed = model(img, speed)
+            with torch.autocast("cuda", dtype=torch.float16):
+                branches_out, pred_speed = model(img, speed)
+            branches_out, pred_speed = branches_out.float(), pred_speed.float()
             branch_loss = criterion(branches_out*mask, target) * 4
             speed_loss = criterion(pred_speed, speed)
-            uncertain_loss = args.branch_weight * branch_loss + args.speed_weight * speed_loss
+            branch_weight, speed_weight = args.loss_weights
+            uncertain_loss = branch_weight * branch_loss + speed_weight * speed_loss
+            # no uncertainty outputs, those meters stay at zero
+            ori_loss = uncertain_control_mean = uncertain_speed_mean = torch.zeros_like(uncertain_loss)
 
-        uncertain_losses.update(uncertain_loss.item(), args.batch_size)         # the usage of the update function
-        branch_losses.update(branch_loss.item(), args.batch_size)
-        speed_losses.update(speed_loss.item(), args.batch_size)
+        # stays on the gpu, no sync, and no autograd node for the stack
+        with torch.no_grad():
+            meters.update(torch.stack([branch_loss, speed_loss, uncertain_loss, ori_loss,
+                                       uncertain_control_mean, uncertain_speed_mean]),
+                          args.batch_size)
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        model.zero_grad()
-        uncertain_loss.backward()
-        optimizer.step()
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(uncertain_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        batch_end.record()
         end = time.time()
 
-        if i % args.print_freq == 0 or i+1 ==len(loader):
-            writer.add_scalar('train/branch_loss', branch_losses.val, step + i)
-            writer.add_scalar('train/speed_loss', speed_losses.val, step + i)
-            writer.add_scalar('train/uncertain_loss', uncertain_losses.val, step + i)
-            writer.add_scalar('train/ori_loss', ori_losses.val, step + i)
-            writer.add_scalar('train/control_uncertain', uncertain_control_means.val, step + i)
-            writer.add_scalar('train/speed_uncertain', uncertain_speed_means.val, step + i)
+        if i % args.print_frequency == 0 or i+1 == len(loader):
+            # measure elapsed time, leaving out the first steps that compile the model
+            if epoch > args.start_epoch or i >= 3:
+                batch_end.synchronize()
+                batch_time.update(batch_start.elapsed_time(batch_end) / 1000.0)
+
+            # the only place the accumulated losses are copied back to the host
+            values = meters.cpu()
+            if log_queue is not None:
+                for name, (val, _) in values.items():
+                    log_queue.put(('train/' + name, val, step + i))
 
             output_log(
                 'Epoch:[{0}][{1}/{2}]\t'
-                'Time {bacth_time.val:.3f}({batch_time.avg:.3f})\t'
+                'Time {batch_time.val:.3f}({batch_time.avg:.3f})\t'
                 'Data {data_time.val:.3f}({data_time.avg:.3f})\t'
-                'Branch loss {branch_loss.val:.3f}({branch_loss.avg:.3f})\t'
-                'Speed loss {Speed_loss.val:.3f}({Speed_loss.avg:.3f})\t'
-                'Uncertain loss {uncertain_loss.val:.4f}({uncertain_loss.avg:.4f})\t'
-                'Ori Loss {ori_loss.val:.4f}({ori_loss.avg:.4f})\t'
-                'Control Uncertain {control_uncertain.val:.4f}({control_uncertain.avg:.4f})\t'
-                'Speed Uncertain {speed_uncertain.val:.4f}({speed_uncertain.avg:.4f})\t'
+                'Branch loss {branch_loss[0]:.3f}({branch_loss[1]:.3f})\t'
+                'Speed loss {speed_loss[0]:.3f}({speed_loss[1]:.3f})\t'
+                'Uncertain loss {uncertain_loss[0]:.4f}({uncertain_loss[1]:.4f})\t'
+                'Ori Loss {ori_loss[0]:.4f}({ori_loss[1]:.4f})\t'
+                'Control Uncertain {control_uncertain[0]:.4f}({control_uncertain[1]:.4f})\t'
+                'Speed Uncertain {speed_uncertain[0]:.4f}({speed_uncertain[1]:.4f})\t'
                 .format(
                     epoch+1, i, len(loader), batch_time=batch_time,
                     data_time=data_time,
-                    branch_loss=branch_losses,
-                    speed_loss=speed_losses,
-                    uncertain_loss=uncertain_losses,
-                    ori_loss=ori_losses,
-                    control_uncertain=uncertain_control_means,
-                    speed_uncertain=uncertain_control_means,
+                    **values
                     ), logging)
 
-    return branch_losses.avg, speed_losses.avg, uncertain_losses.avg
+        batch = prefetcher.next()
+        i += 1
 
+    avg = meters.avg_cpu()
+    return avg['branch_loss'], avg['speed_loss'], avg['uncertain_loss']
 
-def evaluate(loader, model, criterion, epoch, writer):
+
+def evaluate(loader, model, criterion, epoch, log_queue):
     batch_time = AverageMeter()
-    uncertain_losses = AverageMeter()
-    ori_losses = AverageMeter()
-    uncertain_control_means = AverageMeter()
-    uncertain_speed_means = AverageMeter()
+    meters = MeterGroup(['uncertain_loss', 'ori_loss', 'control_uncertain', 'speed_uncertain'],
+                        device='cuda')
 
     # switch to evaluate mode
     model.eval()
     with torch.no_grad():
         end = time.time()
-        for i, (img, speed, target, mask) in enumerate(loader):
-            img = img.cuda(args.cpu, non_blocking=True)
-            speed = speed.cuda(args.cpu, non_blocking=True)
-            target = target.cuda(args.cpu, non_blocking=True)
-            mask = mask.cuda(args.cpu, non_blocking=True)
-
-            branches_out, pred_speed, log_var_control, log_var_speed = model(img, speed)
-
-            mask_out = branches_out * mask
-            ori_branch_loss = criterion(mask_out, target) * 4
-            ori_speed_loss = criterion(pred_speed, speed)
-
-            branch_loss = torch.mean((torch.exp(-log_var_control)
-                                      * torch.pow((branches_out - target), 2)
-                                      + log_var_control) * 0.5 * mask) * 4
-
-            speed_loss = torch.mean((torch.exp(-log_var_speed)
-                                     * torch.pow((pred_speed - speed), 2)
-                                     + log_var_speed) * 0.5)
-
-            uncertain_loss = args.branch_weight*branch_loss + \
-                    args.speed_weight*speed_loss
-            ori_loss = args.branch_weight*ori_branch_loss + \
-                    args.speed_weight*ori_speed_loss
-
-            uncertain_control_mean = torch.mean(torch.exp(log_var_control) * mask * 4)
-            uncertain_speed_mean = torch.mean(torch.exp(log_var_speed))
-
-            uncertain_losses.update(uncertain_loss.item(), args.batch_size)
-            ori_losses.update(ori_loss.item(), args.batch_size)
-            uncertain_control_means.update(uncertain_control_mean.item(),
-                                           args.batch_size)
-            uncertain_speed_means.update(uncertain_speed_mean.item(),
-                                         args.batch_size)
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
+        prefetcher = CUDAPrefetcher(loader)
+        batch = prefetcher.next()
+        i = 0
+        while batch is not None:
+            img, speed, target, mask = batch
+            img = img.to(memory_format=torch.channels_last, non_blocking=True)
+
+            torch.compiler.cudagraph_mark_step_begin()
+            with torch.autocast("cuda", dtype=torch.float16):
+                branches_out, pred_speed, log_var_control, log_var_speed = model(img, speed)
+            branches_out, pred_speed = branches_out.float(), pred_speed.float()
+            log_var_control, log_var_speed = log_var_control.float(), log_var_speed.float()
+
+            uncertain_loss, _, _, ori_loss, \
+                uncertain_control_mean, uncertain_speed_mean = _uncert_loss(
+                    branches_out, target, pred_speed, speed,
+                    log_var_control, log_var_speed, mask,
+                    *args.loss_weights)
+
+            # weighted by the real batch size, the tail batch may be smaller
+            meters.update(torch.stack([uncertain_loss, ori_loss,
+                                       uncertain_control_mean, uncertain_speed_mean]),
+                          img.size(0))
+
+            # measure elapsed time, leaving out the first steps that compile the eval graph
+            if epoch > args.start_epoch or i >= 3:
+                batch_time.update(time.time() - end)
             end = time.time()
-
-        writer.add_scalar('eval/uncertain_loss', uncertain_losses.avg, epoch+1)
-        writer.add_scalar('eval/origin_loss', ori_losses.avg, epoch+1)
-        writer.add_scalar('eval/control_uncertain', uncertain_control_means.avg, epoch+1)
-        writer.add_scalar('eval/speed_uncertain', uncertain_speed_means.avg, epoch+1)
+            batch = prefetcher.next()
+            i += 1
+
+        # every process evaluated its own shard, so all ranks agree on is_best
+        if args.distributed:
+            meters.all_reduce()
+        # a single host copy once the whole epoch is evaluated
+        avg = meters.avg_cpu()
+        uncertain_loss = avg['uncertain_loss']
+        ori_loss = avg['ori_loss']
+        control_uncertain = avg['control_uncertain']
+        speed_uncertain = avg['speed_uncertain']
+
+        if log_queue is not None:
+            log_queue.put(('eval/uncertain_loss', uncertain_loss, epoch+1))
+            log_queue.put(('eval/origin_loss', ori_loss, epoch+1))
+            log_queue.put(('eval/control_uncertain', control_uncertain, epoch+1))
+            log_queue.put(('eval/speed_uncertain', speed_uncertain, epoch+1))
 
         output_log(
             'Epoch Test: [{0}]\t'
             'Time {batch_time.avg:.3f}\t'
-            'Uncertain Loss {uncertain_loss.avg:.4f}\t'
-            'Original Loss {ori_loss.avg:.4f}\t'
-            'Control Uncertain {control_uncertain.avg:.4f}\t'
-            'Speed Uncertain {speed_uncertain.avg:.4f}\t'
+            'Uncertain Loss {1:.4f}\t'
+            'Original Loss {2:.4f}\t'
+            'Control Uncertain {3:.4f}\t'
+            'Speed Uncertain {4:.4f}\t'
             .format(
-                epoch + 1, batch_time=batch_time,
-                uncertain_loss=uncertain_losses,
-                ori_loss=ori_losses,
-                control_uncertain=uncertain_control_means,
-                speed_uncertain=uncertain_speed_means,
+                epoch + 1, uncertain_loss, ori_loss,
+                control_uncertain, speed_uncertain,
+                batch_time=batch_time,
                 ), logging)
 
-    return uncertain_losses.avg
+    return uncertain_loss
 
 
 if __name__ == '__main__':